@@ -4,22 +4,28 @@ Should be similar for other camera's connected to the CSI interface on the Raspb
 """
 
 import time
-import picamera.array
 import picamera
 import os
-import cv2
 import numpy as np
 import subprocess
+import signal
+import threading
+import weakref
 import multiprocessing as mp
 
 from fractions import Fraction
-from PIL import Image
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from astroplant_camera_module.core.camera import CAMERA
 from astroplant_camera_module.core.ndvi import NDVI
 from astroplant_camera_module.misc.debug_print import d_print
 from astroplant_camera_module.typedef import LC
-from astroplant_camera_module.misc.helper import light_control_dummy
+from astroplant_camera_module.misc.helper import light_control_dummy, dark_frame_subtract, read_bmp
+
+# picamera 1.13 can only read the analog and digital gain, later versions can also set them
+GAIN_CONTROL = picamera.PiCamera.analog_gain.fset is not None
 
 
 class SETTINGS_V5(object):
@@ -61,6 +67,9 @@ class SETTINGS_V5(object):
         self.exposure_mode = "off"
         self.exposure_compensation = 0
 
+        # minimum time in seconds the light is on before the bright frame is taken
+        self.light_settle = 0.5
+
         self.allowed_channels = [LC.WHITE, LC.GROWTH, LC.RED, LC.NIR]
 
 
@@ -113,11 +122,21 @@ class PI_CAM_NOIR_V21(CAMERA):
         # set up ndvi routines
         self.ndvi = NDVI(camera = self)
 
-        # set multiprocessing to spawn (so NOT fork)
-        try:
-            mp.set_start_method('spawn')
-        except RuntimeError:
-            pass
+        # allocate the bright and dark frame buffers once, picamera writes rgb data padded to a multiple of 32 in width and 16 in height
+        width, height = self.settings.resolution
+        self.bright_buf = np.empty(((height + 15)//16*16, (width + 31)//32*32, 3), dtype=np.uint8)
+        self.dark_buf = np.empty_like(self.bright_buf)
+
+        # the picamera sensor and the raspistill photo worker process are started on first use
+        self.sensor = None
+        self.start_photo_pool()
+
+        # raspistill commands per channel, assembled on first use and dropped whenever the gains or white balance change
+        self.photo_cmds = dict()
+
+        # raspistill writes its bitmaps to the tmp directory set up by the camera super class
+        self.path_to_bright = "{}/cam/tmp/bright.bmp".format(self.working_directory)
+        self.path_to_dark = "{}/cam/tmp/dark.bmp".format(self.working_directory)
 
 
     def update(self):
@@ -129,59 +148,76 @@ class PI_CAM_NOIR_V21(CAMERA):
         if "d2d" not in self.config:
             self.setup_d2d()
 
+        # resolve the lookups that do not change per channel once
+        light_control = self.light_control
+        wb = self.config["wb"]
+        d2d = self.config["d2d"]
+
         for channel in self.light_channels:
             # turn on the light
-            self.light_control(channel, 1)
+            light_control(channel, 1)
 
             d_print("Letting gains settle for the {} channel...".format(channel), 1)
 
-            with picamera.PiCamera() as sensor:
-                # set up the sensor with all its settings
-                sensor.resolution = self.settings.resolution
-                sensor.framerate = self.settings.framerate[channel]
-                sensor.shutter_speed = self.settings.shutter_speed[channel]
-
-                sensor.awb_mode = "off"
-                sensor.awb_gains = (self.config["wb"][channel]["r"], self.config["wb"][channel]["b"])
-
-                time.sleep(30)
-
-                sensor.exposure_mode = self.settings.exposure_mode
-
-                # there is some non-linearity in the camera for higher pixel values when the gain gets large.
-                # currently, we fix this by limiting the gain to a maximum of 1.5 times the calibration gain.
-                # images will be a bit underexposed, but this can be expected for the red images anyway, since they
-                #     tend to be dark.
+            # set up the sensor with all its settings
+            sensor = self.get_sensor(channel)
+            sensor.awb_gains = (wb[channel]["r"], wb[channel]["b"])
+
+            # wait for the gains to settle, at least 2 and at most 30 seconds. They are considered settled when both changed less than 1% for 3 consecutive samples.
+            # a newly opened sensor reports gains of 0 until the first frames are processed, those samples never count as settled
+            prev_ag = prev_dg = 0.0
+            stable = 0
+            t0 = time.time()
+            time.sleep(2)
+            while time.time() - t0 < 30:
+                time.sleep(0.5)
                 ag = float(sensor.analog_gain)
                 dg = float(sensor.digital_gain)
-
-                if self.CALIBRATED:
-                    if channel == LC.RED or channel == LC.NIR:
-                        if self.config["ff"]["gain"][channel]*1.5 < ag:
-                            self.config["d2d"][channel]["analog-gain"] = self.config["ff"]["gain"][channel]*1.5
-                        elif self.config["ff"]["gain"][channel]*0.67 > ag:
-                            self.config["d2d"][channel]["analog-gain"] = self.config["ff"]["gain"][channel]*0.67
-                        else:
-                            self.config["d2d"][channel]["analog-gain"] = ag
+                if ag > 0 and dg > 0 and abs(ag - prev_ag) < 0.01*ag and abs(dg - prev_dg) < 0.01*dg:
+                    stable += 1
+                    if stable >= 3:
+                        break
+                else:
+                    stable = 0
+                prev_ag, prev_dg = ag, dg
+
+            sensor.exposure_mode = self.settings.exposure_mode
+
+            # there is some non-linearity in the camera for higher pixel values when the gain gets large.
+            # currently, we fix this by limiting the gain to a maximum of 1.5 times the calibration gain.
+            # images will be a bit underexposed, but this can be expected for the red images anyway, since they
+            #     tend to be dark.
+            ag = float(sensor.analog_gain)
+            dg = float(sensor.digital_gain)
+
+            if self.CALIBRATED:
+                if channel == LC.RED or channel == LC.NIR:
+                    if self.config["ff"]["gain"][channel]*1.5 < ag:
+                        d2d[channel]["analog-gain"] = self.config["ff"]["gain"][channel]*1.5
+                    elif self.config["ff"]["gain"][channel]*0.67 > ag:
+                        d2d[channel]["analog-gain"] = self.config["ff"]["gain"][channel]*0.67
                     else:
-                        self.config["d2d"][channel]["analog-gain"] = ag
+                        d2d[channel]["analog-gain"] = ag
+                else:
+                    d2d[channel]["analog-gain"] = ag
 
-                    if dg > 2 and (channel == LC.RED or channel == LC.NIR):
-                        self.config["d2d"][channel]["digital-gain"] = 2
-                    else:
-                        self.config["d2d"][channel]["digital-gain"] = dg
+                if dg > 2 and (channel == LC.RED or channel == LC.NIR):
+                    d2d[channel]["digital-gain"] = 2
                 else:
-                    self.config["d2d"][channel]["digital-gain"] = dg
-                    self.config["d2d"][channel]["analog-gain"] = ag
+                    d2d[channel]["digital-gain"] = dg
+            else:
+                d2d[channel]["digital-gain"] = dg
+                d2d[channel]["analog-gain"] = ag
 
-                d_print("Measured ag: {} and dg: {} for channel {}".format(ag, dg, channel), 1)
-                d_print("Saved ag: {} and dg: {} for channel {}".format(self.config["d2d"][channel]["analog-gain"], self.config["d2d"][channel]["digital-gain"], channel), 1)
+            d_print("Measured ag: {} and dg: {} for channel {}".format(ag, dg, channel), 1)
+            d_print("Saved ag: {} and dg: {} for channel {}".format(d2d[channel]["analog-gain"], d2d[channel]["digital-gain"], channel), 1)
 
             # turn the light off
-            self.light_control(channel, 0)
+            light_control(channel, 0)
 
         # update timestamp
-        self.config["d2d"]["timestamp"] = time.time()
+        d2d["timestamp"] = time.time()
+        self.photo_cmds.clear()
 
         # save the new configuration to file
         self.save_config_to_file()
@@ -189,7 +225,7 @@ class PI_CAM_NOIR_V21(CAMERA):
 
     def capture(self, channel: LC):
         """
-        Function that captures an image. Uses raspistill in a separate terminal process to take the picture. This is faster (about 4-5 seconds to take an image on average) due to the possibility to manually set the gains of the camera, something that is not possible in picamera 1.13 (but will probably be in version 1.14 or 1.15).
+        Function that captures an image. The bright and dark frame are captured in-process using picamera, directly into rgb arrays. picamera 1.13 is not able to set the gains of the camera manually (later versions are), in that case raspistill is used in a separate terminal process as a fallback (about 4-5 seconds to take an image on average).
 
         :param channel: channel of light in which the photo is taken, used for white balance and gain values
         :return: 8 bit rgb array containing the image
@@ -200,48 +236,213 @@ class PI_CAM_NOIR_V21(CAMERA):
             self.setup_d2d()
             self.update()
 
+        gain = self.config["d2d"][channel]["analog-gain"] * self.config["d2d"][channel]["digital-gain"]
+
+        # take the bright and dark picture and perform dark frame subtraction
+        if GAIN_CONTROL:
+            rgb = self.capture_picamera(channel)
+        else:
+            rgb = self.capture_raspistill(channel)
+
+        # catch error
+        if rgb is None:
+            return (None, 0)
+
+        # if the time since last update is larger than a day, update the gains after the photo
+        if time.time() - self.config["d2d"]["timestamp"] > 3600*24:
+            self.update()
+
+        return (rgb, gain)
+
+
+    def capture_picamera(self, channel: LC):
+        """
+        Subfunction that captures the bright and dark frame back-to-back using a single picamera instance. Requires a picamera version that is able to set the analog and digital gain.
+
+        :param channel: channel of light in which the photo is taken, used for white balance and gain values
+        :return: 8 bit rgb array containing the dark frame subtracted image, None on failure. The array is a view on the frame buffer and is overwritten by the next capture
+        """
+
+        # turn on the light in the background while the sensor is being set up
+        light_on = threading.Thread(target=self.light_control, args=(channel, 1))
+        light_on.start()
+        t_light = time.time()
+
+        try:
+            # set up the sensor with all its settings
+            sensor = self.get_sensor(channel)
+            sensor.awb_gains = (self.config["wb"][channel]["r"], self.config["wb"][channel]["b"])
+
+            # lock exposure and set the gains determined by the update function
+            ag = self.config["d2d"][channel]["analog-gain"]
+            sensor.exposure_mode = self.settings.exposure_mode
+            sensor.analog_gain = ag
+            sensor.digital_gain = self.config["d2d"][channel]["digital-gain"]
+
+            # wait until the sensor runs at the requested shutter speed and gain, at most as long as the raspistill preview
+            ss = self.settings.shutter_speed[channel]
+            t0 = time.time()
+            while time.time() - t0 < 1:
+                if abs(sensor.exposure_speed - ss) < 0.01*ss and abs(float(sensor.analog_gain) - ag) < 0.02*ag:
+                    break
+                time.sleep(0.05)
+            light_on.join()
+
+            # give the light at least its settle time, counted from switching it on
+            remaining = self.settings.light_settle - (time.time() - t_light)
+            if remaining > 0:
+                time.sleep(remaining)
+
+            sensor.capture(self.bright_buf, 'rgb')
+
+            # turn off the light
+            self.light_control(channel, 0)
+
+            # the growth lighting is not controlled by the camera, so a dark frame is of no use
+            if channel != LC.GROWTH:
+                sensor.capture(self.dark_buf, 'rgb')
+                dark_frame_subtract(self.bright_buf, self.dark_buf)
+
+            width, height = self.settings.resolution
+            return self.bright_buf[:height, :width]
+        except picamera.PiCameraError as e:
+            light_on.join()
+            self.light_control(channel, 0)
+            self.close()
+            d_print("Could not capture image: {}".format(e), 3)
+            return None
+
+
+    def capture_raspistill(self, channel: LC):
+        """
+        Subfunction that captures the bright and dark frame using raspistill, which is able to set the gains manually on all picamera versions.
+
+        :param channel: channel of light in which the photo is taken, used for white balance and gain values
+        :return: 8 bit rgb array containing the dark frame subtracted image, None on failure. The array is a view on the frame buffer and is overwritten by the next capture
+        """
+
+        # raspistill needs the camera for itself
+        self.close()
+
         # turn on the light
         self.light_control(channel, 1)
 
         # assemble the terminal command
-        path_to_bright = os.getcwd() + "/cam/tmp/bright.bmp"
-        path_to_dark = os.getcwd() + "/cam/tmp/dark.bmp"
-        gain = self.config["d2d"][channel]["analog-gain"] * self.config["d2d"][channel]["digital-gain"]
+        if channel not in self.photo_cmds:
+            self.photo_cmds[channel] = "raspistill -e bmp -w {} -h {} -ss {} -t 1000 -awb off -awbg {},{} -ag {} -dg {} -o {{}}".format(self.settings.resolution[0], self.settings.resolution[1], self.settings.shutter_speed[channel], self.config["wb"][channel]["r"], self.config["wb"][channel]["b"], self.config["d2d"][channel]["analog-gain"], self.config["d2d"][channel]["digital-gain"])
 
-        photo_cmd = "raspistill -e bmp -w {} -h {} -ss {} -t 1000 -awb off -awbg {},{} -ag {} -dg {}".format(self.settings.resolution[0], self.settings.resolution[1], self.settings.shutter_speed[channel], self.config["wb"][channel]["r"], self.config["wb"][channel]["b"], self.config["d2d"][channel]["analog-gain"], self.config["d2d"][channel]["digital-gain"])
-
-        # run command and take bright and dark picture
-        # start the bright image capture by spawning a clean process and executing the command, then waiting for the q
-        p = mp.Process(target=photo_worker, args=(photo_cmd + " -o {}".format(path_to_bright),))
-        try:
-            p.start()
-            p.join()
-        except OSError:
-            d_print("Could not start child process, out of memory", 3)
-            return (None, 0)
+        # run command and take the bright picture
+        photo = self.start_photo_cmd(self.photo_cmds[channel].format(self.path_to_bright))
+        if photo is None or not self.wait_photo_cmd(photo):
+            self.light_control(channel, 0)
+            return None
         # turn off the light
         self.light_control(channel, 0)
-        # start the dark image capture by spawning a clean process and executing the command, then waiting for the q
-        p = mp.Process(target=photo_worker, args=(photo_cmd + " -o {}".format(path_to_dark),))
+
+        width, height = self.settings.resolution
+        rgb = self.bright_buf[:height, :width]
+        dark = self.dark_buf[:height, :width]
+
+        # the growth lighting is not controlled by the camera, so a dark frame is of no use
+        if channel == LC.GROWTH:
+            try:
+                read_bmp(self.path_to_bright, rgb)
+            except (EnvironmentError, ValueError) as e:
+                d_print("Could not read image: {}".format(e), 3)
+                return None
+
+            return rgb
+
+        # start the dark picture and load the bright image from file into its frame buffer while the dark one is being taken
+        photo = self.start_photo_cmd(self.photo_cmds[channel].format(self.path_to_dark))
+        if photo is None:
+            return None
         try:
-            p.start()
-            p.join()
-        except OSError:
+            read_bmp(self.path_to_bright, rgb)
+        except (EnvironmentError, ValueError) as e:
+            d_print("Could not read image: {}".format(e), 3)
+            # still wait for the dark picture, so the next photo does not find the camera in use
+            self.wait_photo_cmd(photo)
+            return None
+        if not self.wait_photo_cmd(photo):
+            return None
+
+        # load the dark image, perform dark frame subtraction and return the array
+        try:
+            read_bmp(self.path_to_dark, dark)
+        except (EnvironmentError, ValueError) as e:
+            d_print("Could not read image: {}".format(e), 3)
+            return None
+        dark_frame_subtract(rgb, dark)
+
+        return rgb
+
+
+    def start_photo_pool(self):
+        """
+        Set up the pool with the single process that executes the photo commands. Because of the implementation of subprocess (which forks the entire process) the commands are executed from a separate process with a way smaller footprint, started using spawn (so NOT fork). The process is started on first use and reused for all following photos, so the interpreter startup is only paid once.
+        """
+
+        # the worker reports its pid and leads its own process group, so it can be stopped together with the raspistill it started
+        ctx = mp.get_context('spawn')
+        self.photo_pid = ctx.Value('i', 0)
+        self.photo_pool = ProcessPoolExecutor(max_workers=1, mp_context=ctx, initializer=photo_worker_init, initargs=(self.photo_pid,))
+
+        # stop the worker when the camera object is cleaned up
+        weakref.finalize(self, self.photo_pool.shutdown, wait=False)
+
+
+    def restart_photo_pool(self):
+        """
+        Kill the photo worker process together with any photo command it is still executing, so it releases the camera, and set up a new pool for the next photo.
+        """
+
+        # a pid of 0 means the worker has not started yet, so there is nothing to kill
+        pid = self.photo_pid.value
+        if pid != 0:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                # the worker is not (yet) leading its own process group, kill just the worker
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+        self.photo_pool.shutdown(wait=False)
+        self.start_photo_pool()
+
+
+    def start_photo_cmd(self, cmd):
+        """
+        Subfunction that hands a photo command to the photo worker process without waiting for it.
+
+        :param cmd: photo command to be executed
+        :return: future of the photo command, None if the command could not be started
+        """
+
+        try:
+            return self.photo_pool.submit(photo_worker, cmd)
+        except (OSError, BrokenProcessPool):
             d_print("Could not start child process, out of memory", 3)
-            return (None, 0)
+            self.restart_photo_pool()
+            return None
 
-        # load the images from file, perform dark frame subtraction and return the array
-        bright = Image.open(path_to_bright)
-        rgb = np.array(bright)
-        if channel != LC.GROWTH:
-            dark = Image.open(path_to_dark)
-            rgb = cv2.subtract(rgb, np.array(dark))
 
-        # if the time since last update is larger than a day, update the gains after the photo
-        if time.time() - self.config["d2d"]["timestamp"] > 3600*24:
-            self.update()
+    def wait_photo_cmd(self, photo):
+        """
+        Subfunction that waits until the photo worker process has executed a photo command.
 
-        return (rgb, gain)
+        :param photo: future of the photo command, as returned by start_photo_cmd
+        :return: True if the photo was taken, False otherwise
+        """
+
+        try:
+            return photo.result(timeout=25) == 0
+        except (futures.TimeoutError, BrokenProcessPool):
+            d_print("Photo worker did not respond, restarting it for the next photo", 3)
+            self.restart_photo_pool()
+            return False
 
 
     def calibrate_white_balance(self, channel: LC):
@@ -257,49 +458,47 @@ class PI_CAM_NOIR_V21(CAMERA):
         self.light_control(channel, 1)
 
         if channel == LC.WHITE or channel == LC.NIR:
-            with picamera.PiCamera() as sensor:
-                # set up the sensor with all its settings
-                sensor.resolution = (128, 80)
-                sensor.rotation = self.config["rotation"]
-                sensor.framerate = self.settings.framerate[channel]
-                sensor.shutter_speed = self.settings.shutter_speed[channel]
-
-                # set up the blue and red gains
-                sensor.awb_mode = "off"
-                rg, bg = (1.1, 1.1)
+            # set up the sensor with all its settings
+            sensor = self.get_sensor(channel, resolution = (128, 80))
+            sensor.rotation = self.config["rotation"]
+
+            # set up the blue and red gains
+            rg, bg = (1.1, 1.1)
+            sensor.awb_gains = (rg, bg)
+
+            # now sleep and lock exposure
+            time.sleep(20)
+            sensor.exposure_mode = self.settings.exposure_mode
+
+            # record camera data to a numpy array that is reused for every capture (128x80 needs no padding)
+            rgb = np.empty((80, 128, 3), dtype=np.uint8)
+
+            # capture images from the video port, which keeps the capture pipeline running, and analyze until convergence.
+            # the channel means scale about linearly with the gains so a few corrections suffice
+            for i, _ in enumerate(sensor.capture_continuous(rgb, 'rgb', use_video_port=True)):
+                # the frame right after a gain change may still be processed with the old gains, so only every other frame is analyzed
+                if i % 2:
+                    continue
+
+                # the crop is only read before the next capture, so a view is enough. Every other pixel suffices to judge the balance
+                #crop = rgb[508:708,666:966,:]
+                crop = rgb[30:50:2, 32:96:2, :]
+
+                # sum in integers (fits easily in 32 bits) instead of averaging in floats
+                r, g, b = crop.sum(axis=(0, 1), dtype=np.uint32)*(1.0/(crop.shape[0]*crop.shape[1]))
+                d_print("\trg: {:4.3f} bg: {:4.3f} --- ({:4.1f}, {:4.1f}, {:4.1f})".format(rg, bg, r, g, b), 1)
+
+                if abs(r - g) < 1 and abs(b - g) < 1:
+                    break
+
+                # scale the gains by the ratio to the green channel, within the range picamera accepts. A gain of 0 could never be scaled up again, so keep a positive floor
+                rg = np.clip(rg*g/max(r, 1e-3), 0.1, 8.0)
+                bg = np.clip(bg*g/max(b, 1e-3), 0.1, 8.0)
+
                 sensor.awb_gains = (rg, bg)
 
-                # now sleep and lock exposure
-                time.sleep(20)
-                sensor.exposure_mode = self.settings.exposure_mode
-
-                # record camera data to array and scale up a numpy array
-                #rgb = np.zeros((1216,1216,3), dtype=np.uint16)
-                with picamera.array.PiRGBArray(sensor) as output:
-                    # capture images and analyze until convergence
-                    for i in range(30):
-                        output.truncate(0)
-                        sensor.capture(output, 'rgb')
-                        rgb = np.copy(output.array)
-
-                        #crop = rgb[508:708,666:966,:]
-                        crop = rgb[30:50,32:96,:]
-
-                        r, g, b = (np.mean(crop[..., i]) for i in range(3))
-                        d_print("\trg: {:4.3f} bg: {:4.3f} --- ({:4.1f}, {:4.1f}, {:4.1f})".format(rg, bg, r, g, b), 1)
-
-                        if abs(r - g) > 1:
-                            if r > g:
-                                rg -= 0.025
-                            else:
-                                rg += 0.025
-                        if abs(b - g) > 1:
-                            if b > g:
-                                bg -= 0.025
-                            else:
-                                bg += 0.025
-
-                        sensor.awb_gains = (rg, bg)
+                if i >= 10:
+                    break
         elif channel == LC.GROWTH:
             rg = self.settings.wb[LC.GROWTH]["r"]
             bg = self.settings.wb[LC.GROWTH]["b"]
@@ -311,12 +510,48 @@ class PI_CAM_NOIR_V21(CAMERA):
         self.light_control(channel, 0)
 
         self.config["wb"][channel] = dict()
-        self.config["wb"][channel]["r"] = rg
-        self.config["wb"][channel]["b"] = bg
+        self.config["wb"][channel]["r"] = float(rg)
+        self.config["wb"][channel]["b"] = float(bg)
+        self.photo_cmds.pop(channel, None)
 
         d_print("Done.", 1)
 
 
+    def get_sensor(self, channel: LC, resolution = None):
+        """
+        Subfunction that returns the picamera sensor set up for the given light channel. The sensor is opened on first use and kept open afterwards, so the camera pipeline is not set up again for every use.
+
+        :param channel: channel of light the sensor is set up for, used for framerate and shutter speed
+        :param resolution: resolution of the sensor, defaults to the resolution in the settings
+        :return: picamera sensor object
+        """
+
+        if self.sensor is None:
+            self.sensor = picamera.PiCamera()
+            # close the sensor when the camera object is cleaned up or the program exits
+            weakref.finalize(self, self.sensor.close)
+
+        self.sensor.resolution = resolution or self.settings.resolution
+        self.sensor.framerate = self.settings.framerate[channel]
+        self.sensor.shutter_speed = self.settings.shutter_speed[channel]
+
+        # white balance is always set manually, the exposure is unlocked again in case an earlier use locked it
+        self.sensor.awb_mode = "off"
+        self.sensor.exposure_mode = "auto"
+
+        return self.sensor
+
+
+    def close(self):
+        """
+        Close the picamera sensor if it is open.
+        """
+
+        if self.sensor is not None:
+            self.sensor.close()
+            self.sensor = None
+
+
     def setup_d2d(self):
         """
         Function that sets up the fields required for the update function to work. These are saved in explicit dicts so that the chances of errors are minimal.
@@ -342,16 +577,32 @@ class PI_CAM_NOIR_V21(CAMERA):
             self.config["d2d"][LC.NIR]["digital-gain"] = 1.5
 
         self.config["d2d"]["timestamp"] = time.time()
+        self.photo_cmds.clear()
 
         self.save_config_to_file()
 
 
+def photo_worker_init(photo_pid):
+    """
+    Function that sets up the photo worker process: it reports its pid and makes itself the leader of a new process group.
+
+    :param photo_pid: shared value the pid of the worker is written to
+    """
+
+    photo_pid.value = os.getpid()
+    os.setpgrp()
+
+
 def photo_worker(cmd):
     """
-    Function that executes a photo command. Because of the implementation of subprocess (which forks the entire process) a new thread is first made with a way smaller footprint. This ensures that memory usage stays as low as possible and the program doesn't crash when memory gets scarce.
+    Function that executes a photo command. Runs in the photo worker process.
 
-    :param q: Queue in which a signal is posted when the photo is done
     :param cmd: Photo command to be executed
+    :return: return code of the command, -1 if it timed out
     """
 
-    subprocess.run(cmd, shell=True, timeout=20)
+    try:
+        # exec replaces the shell by the command, so the timeout kills the command itself and not just the shell
+        return subprocess.run("exec " + cmd, shell=True, timeout=20).returncode
+    except subprocess.TimeoutExpired:
+        return -1
@@ -8,6 +8,9 @@ import datetime
 import abc
 import os
 import json
+import queue
+import threading
+import weakref
 import cv2
 
 import numpy as np
@@ -17,6 +20,13 @@ from astroplant_camera_module.misc.debug_print import d_print
 from astroplant_camera_module.typedef import CC, LC
 from astroplant_camera_module.setup import check_directories
 
+# commands that make a photo with a single light channel, and the channel they use
+PHOTO_CHANNELS = {
+    CC.WHITE_PHOTO: LC.WHITE,
+    CC.GROWTH_PHOTO: LC.GROWTH,
+    CC.NIR_PHOTO: LC.NIR
+}
+
 class CAMERA(object):
     def __init__(self, *args, light_control, working_directory, **kwargs):
         """
@@ -37,24 +47,31 @@ class CAMERA(object):
         # check and set up the necessary directories
         check_directories(self.working_directory)
 
+        # photos are written to file by a background thread, so encoding them does not hold up the caller
+        # paths of photos that could not be written are collected in write_failures until they are reported
+        self.writer_q = queue.Queue(maxsize=4)
+        self.write_failures = []
+        writer = threading.Thread(target=image_writer, args=(self.writer_q, self.write_failures), daemon=True)
+        writer.start()
+
+        # write out the remaining photos and stop the thread when the camera object is cleaned up or the program exits
+        weakref.finalize(self, stop_image_writer, self.writer_q, writer)
+
 
     def do(self, command: CC):
         """
         Function that directs the commands from the user to the right place. Does some preliminary checks to see if actions are allowed in the current state of the camera (uncalibrated etc.). Throws an error on the command line if actions are illegal.
+        Photos are written to file in the background: call flush before reading the files in "photo_path" of the result, it returns the paths of the photos that could not be written.
 
         :param command: (C)amera (C)ommand, what the user wants to do.
         """
 
-        if command == CC.WHITE_PHOTO and LC.WHITE in self.light_channels and self.CALIBRATED:
-            return self.photo(LC.WHITE)
+        if command in PHOTO_CHANNELS and PHOTO_CHANNELS[command] in self.light_channels and self.CALIBRATED:
+            return self.photo(PHOTO_CHANNELS[command])
         elif command == CC.NDVI_PHOTO and self.NDVI_CAPABLE and self.CALIBRATED:
             return self.ndvi.ndvi_photo()
-        elif command == CC.GROWTH_PHOTO and LC.GROWTH in self.light_channels and self.CALIBRATED:
-            return self.photo(LC.GROWTH)
         elif command == CC.NDVI and self.NDVI_CAPABLE and self.CALIBRATED:
             return self.ndvi.ndvi()
-        elif command == CC.NIR_PHOTO and LC.NIR in self.light_channels and self.CALIBRATED:
-            return self.photo(LC.NIR)
         elif command == CC.CALIBRATE:
             self.calibrate()
         elif command == CC.UPDATE and self.HAS_UPDATE and self.CALIBRATED:
@@ -99,14 +116,19 @@ class CAMERA(object):
 
     def photo(self, channel: LC):
         """
-        Make a photo with the specified light channel and save the image to disk
+        Make a photo with the specified light channel and save the image to disk. The image is written by a background thread, so the file in "photo_path" only exists after flush has been called (which also reports photos that could not be written).
+        Photos of earlier calls that could not be written are reported in "failed_photo_path".
 
         :param channel: channel of light a photo needs to be taken from
         :return: path to the photo taken
         """
 
+        # report photos that could not be written since the last call
+        failed = self.take_write_failures()
+
         # capture a photo of the appropriate channel
         rgb, _ = self.capture(channel)
+        curr_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
 
         # catch error
         if rgb is None:
@@ -115,17 +137,18 @@ class CAMERA(object):
             res["contains_value"] = False
             res["encountered_error"] = True
             res["timestamp"] = curr_time
+            if failed:
+                res["failed_photo_path"] = failed
 
             return res
 
         # crop the sensor readout
         rgb = rgb[self.settings.crop["y_min"]:self.settings.crop["y_max"], self.settings.crop["x_min"]:self.settings.crop["x_max"], :]
 
-        # write image to file using imageio's imwrite
+        # hand a copy of the image to the writer thread, the capture buffer is reused by the next photo
         d_print("Writing to file...", 1)
-        curr_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
         path_to_img = "{}/cam/img/{}_{}.jpg".format(self.working_directory, channel, curr_time)
-        imwrite(path_to_img, rgb)
+        self.writer_q.put((path_to_img, rgb.copy()))
 
         res = dict()
         res["contains_photo"] = True
@@ -134,10 +157,41 @@ class CAMERA(object):
         res["timestamp"] = curr_time
         res["photo_path"] = [path_to_img]
         res["photo_kind"] = [channel]
+        if failed:
+            res["failed_photo_path"] = failed
 
         return(res)
 
 
+    def flush(self):
+        """
+        Wait until all photos handed to the writer thread are written to file.
+
+        :return: list of paths of the photos that could not be written since the last report
+        """
+
+        self.writer_q.join()
+
+        return self.take_write_failures()
+
+
+    def take_write_failures(self):
+        """
+        Subfunction that returns the paths of the photos that could not be written since the last report, and logs them as an error.
+
+        :return: list of paths of the photos that could not be written
+        """
+
+        failed = []
+        while self.write_failures:
+            failed.append(self.write_failures.pop(0))
+
+        if failed:
+            d_print("Could not write photos to file: {}".format(failed), 3)
+
+        return failed
+
+
     def calibrate(self):
         """
         Calibrates the camera and the light sources.
@@ -241,3 +295,33 @@ class CAMERA(object):
         print("    settings:        {}".format(self.settings))
 
         print("")
+
+
+def image_writer(writer_q, write_failures):
+    """
+    Function that writes the images in the queue to file using imageio's imwrite, until it receives None. Runs in a background thread.
+
+    :param writer_q: Queue containing (path, image) tuples
+    :param write_failures: list to which the paths of images that could not be written are appended
+    """
+
+    for path_to_img, img in iter(writer_q.get, None):
+        try:
+            imwrite(path_to_img, img)
+        except Exception as e:
+            d_print("Could not write {}: {}".format(path_to_img, e), 3)
+            write_failures.append(path_to_img)
+        finally:
+            writer_q.task_done()
+
+
+def stop_image_writer(writer_q, writer):
+    """
+    Function that stops the image writer thread after it has written the remaining images.
+
+    :param writer_q: Queue the image writer takes its images from
+    :param writer: the image writer thread
+    """
+
+    writer_q.put(None)
+    writer.join()
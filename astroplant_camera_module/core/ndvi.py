@@ -1,5 +1,6 @@
 import datetime
 import time
+import weakref
 import cv2
 
 import numpy as np
@@ -32,7 +33,8 @@ class NDVI(object):
         :param camera: link to the camera object controlling these subroutines
         """
 
-        self.camera = camera
+        # only a weak reference, so the camera does not end up in a reference cycle and releases the sensor as soon as it is deleted
+        self.camera = weakref.proxy(camera)
 
 
     def ndvi_matrix(self):
@@ -42,17 +44,24 @@ class NDVI(object):
         :return: ndvi matrix
         """
 
-        # capture images in a square rgb array
+        # capture the red image in a square rgb array
         rgb_r, gain_r = self.camera.capture(LC.RED)
-        rgb_nir, gain_nir = self.camera.capture(LC.NIR)
 
         # if an error is caught upstream, send it downstream
-        if rgb_r is None or rgb_nir is None:
+        if rgb_r is None:
             return None
 
         # crop the sensor readout
         rgb_r = rgb_r[self.camera.settings.crop["y_min"]:self.camera.settings.crop["y_max"], self.camera.settings.crop["x_min"]:self.camera.settings.crop["x_max"], :]
-        r = rgb_r[:,:,0]
+        # the camera reuses its frame buffer for the nir capture, so keep a copy of the red channel before taking it
+        r = rgb_r[:,:,0].copy()
+
+        # capture the nir image in a square rgb array
+        rgb_nir, gain_nir = self.camera.capture(LC.NIR)
+
+        # if an error is caught upstream, send it downstream
+        if rgb_nir is None:
+            return None
 
         # apply flatfield mask
         mask = self.camera.config["ff"]["value"]["red"]
@@ -110,6 +119,7 @@ class NDVI(object):
 
         # get the ndvi matrix
         ndvi_matrix = self.ndvi_matrix()
+        curr_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
 
         # catch error
         if ndvi_matrix is None:
@@ -134,7 +144,6 @@ class NDVI(object):
 
         # write images to file using imageio's imwrite and matplotlibs savefig
         d_print("Writing to file...", 1)
-        curr_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
 
         # set multiprocessing to spawn (so NOT fork)
         try:
@@ -185,6 +194,7 @@ class NDVI(object):
 
         # get the ndvi matrix
         ndvi_matrix = self.ndvi_matrix()
+        curr_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
 
         # catch error
         if ndvi_matrix is None:
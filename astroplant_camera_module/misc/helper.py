@@ -1,4 +1,10 @@
 import time
+import os
+import mmap
+import struct
+import cv2
+
+import numpy as np
 
 from astroplant_camera_module.typedef import LC
 from astroplant_camera_module.misc.debug_print import d_print
@@ -7,3 +13,44 @@ def light_control_dummy(channel: LC, state):
     d_print("light_control dummmy called, passing...", 1)
 
     time.sleep(0.1)
+
+def dark_frame_subtract(bright, dark):
+    """
+    Subtract the dark frame from the bright frame in place. The subtraction saturates at 0 and is vectorized by OpenCV (NEON on the Raspberry Pi), writing into the bright frame avoids allocating a third frame.
+
+    :param bright: 8 bit rgb array containing the bright frame, overwritten with the result
+    :param dark: 8 bit rgb array containing the dark frame
+    :return: the bright array
+    """
+
+    return cv2.subtract(bright, dark, dst=bright)
+
+def read_bmp(path, out):
+    """
+    Read an uncompressed 24 bit bitmap, as written by raspistill, into an existing rgb array. The file is memory mapped, so the pixel data is copied only once (straight from the page cache into the array) and dropped from the page cache afterwards.
+
+    :param path: path to the bitmap
+    :param out: 8 bit rgb array with the same size as the bitmap, the image is written into it
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        with mmap.mmap(fd, 0, prot=mmap.PROT_READ) as mm:
+            offset, = struct.unpack_from("<I", mm, 10)
+            width, height, _, bits, compression = struct.unpack_from("<iiHHI", mm, 18)
+            if bits != 24 or compression != 0 or (abs(height), width) != out.shape[:2]:
+                raise ValueError("{} is not an uncompressed {}x{} 24 bit bitmap".format(path, out.shape[1], out.shape[0]))
+
+            # rows are padded to a multiple of 4 bytes and stored in bgr order, bottom-up unless the height is negative
+            stride = (width*3 + 3)//4*4
+            pixels = np.frombuffer(mm, dtype=np.uint8, count=stride*abs(height), offset=offset).reshape(abs(height), stride)[:, :width*3].reshape(abs(height), width, 3)
+            if height > 0:
+                pixels = pixels[::-1]
+            out[...] = pixels[..., ::-1]
+
+            # the map can only be closed once no array refers to it anymore
+            del pixels
+
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)